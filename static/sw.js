@@ -0,0 +1,437 @@
+/*jshint esversion: 6 */
+
+var SHELL_CACHE = 'khconfdvr-shell-v1';
+var RECORDING_CACHE = 'khconfdvr-recordings';
+var CHUNK_CACHE = 'khconfdvr-chunks';
+var CHUNK_SIZE = 4 * 1024 * 1024;
+// leave head room so the browser does not evict the whole origin
+var QUOTA_USAGE_LIMIT = 0.8;
+
+var SHELL_URLS = [
+    '/',
+    '/app.css',
+    '/manifest.json',
+    '/menu.svg',
+    '/posters/blank.jpg',
+    '/posters/processing_mp4_en.jpg'
+];
+// the page registers the worker with its versioned app_<n>.js so the
+// script is cached on the very first visit
+var JSAPP_URL = new URL(self.location).searchParams.get('jsapp');
+if (JSAPP_URL) {
+    SHELL_URLS.push(JSAPP_URL);
+}
+var CLAPPR_URL = 'https://cdn.jsdelivr.net/npm/clappr@latest/dist/clappr.min.js';
+
+
+self.addEventListener('install', function (event) {
+    event.waitUntil(caches.open(SHELL_CACHE).then(function (cache) {
+        return cache.addAll(SHELL_URLS).then(function () {
+            return cache.add(CLAPPR_URL).catch(function () {
+                console.log('could not precache clappr player');
+            });
+        });
+    }).then(function () {
+        return self.skipWaiting();
+    }));
+});
+
+
+self.addEventListener('activate', function (event) {
+    event.waitUntil(caches.keys().then(function (keys) {
+        return Promise.all(keys.filter(function (key) {
+            return key.startsWith('khconfdvr-shell-') && key != SHELL_CACHE;
+        }).map(function (key) {
+            return caches.delete(key);
+        }));
+    }).then(function () {
+        return self.clients.claim();
+    }));
+});
+
+
+var isShellAsset = function (url) {
+    if (url.href == CLAPPR_URL) {
+        return true;
+    }
+    if (url.origin != self.location.origin) {
+        return false;
+    }
+    return SHELL_URLS.indexOf(url.pathname) >= 0 ||
+        /^\/app_\d+\.js$/.test(url.pathname) ||
+        url.pathname.startsWith('/posters/');
+};
+
+
+var networkFirst = function (request, fallbackUrl) {
+    return fetch(request).then(function (response) {
+        if (response.ok) {
+            var copy = response.clone();
+            caches.open(SHELL_CACHE).then(function (cache) {
+                cache.put(request, copy);
+            });
+        }
+        return response;
+    }).catch(function () {
+        return caches.match(request).then(function (cached) {
+            if (cached || !fallbackUrl) {
+                return cached || Response.error();
+            }
+            return caches.match(fallbackUrl);
+        });
+    });
+};
+
+
+var staleWhileRevalidate = function (request) {
+    return caches.open(SHELL_CACHE).then(function (cache) {
+        return cache.match(request).then(function (cached) {
+            var fetched = fetch(request).then(function (response) {
+                if (response.ok) {
+                    cache.put(request, response.clone());
+                }
+                return response;
+            });
+            if (cached) {
+                fetched.catch(function () {});
+                return cached;
+            }
+            return fetched;
+        });
+    });
+};
+
+
+var rangeResponse = function (request, response) {
+    var range = request.headers.get('range');
+    if (!range) {
+        return response;
+    }
+    return response.blob().then(function (blob) {
+        var match = /^bytes=(\d*)-(\d*)$/.exec(range.trim());
+        var start = 0;
+        var end = blob.size - 1;
+        if (match && match[1]) {
+            start = parseInt(match[1], 10);
+            if (match[2]) {
+                end = Math.min(parseInt(match[2], 10), blob.size - 1);
+            }
+        } else if (match && match[2]) {
+            start = Math.max(blob.size - parseInt(match[2], 10), 0);
+        }
+        if (!match || start > end) {
+            return new Response(null, {
+                status: 416,
+                headers: { 'Content-Range': 'bytes */' + blob.size }
+            });
+        }
+        return new Response(blob.slice(start, end + 1), {
+            status: 206,
+            headers: {
+                'Content-Type': response.headers.get('Content-Type') || 'video/mp4',
+                'Content-Length': String(end - start + 1),
+                'Content-Range': 'bytes ' + start + '-' + end + '/' + blob.size,
+                'Accept-Ranges': 'bytes'
+            }
+        });
+    });
+};
+
+
+var getValidator = function (response) {
+    return response.headers.get('ETag') || response.headers.get('Last-Modified') || '';
+};
+
+
+var discardRecording = function (url) {
+    console.log('cached copy of ' + url + ' is out of date.. discarding');
+    delete revalidated[url];
+    return Promise.all([
+        caches.open(RECORDING_CACHE).then(function (cache) {
+            return cache.delete(url);
+        }),
+        deleteChunks(url)
+    ]);
+};
+
+
+// recordings already checked against the box, so range requests made
+// while seeking do not each cost a HEAD request
+var revalidated = {};
+var REVALIDATE_INTERVAL = 60 * 1000;
+
+var isCurrent = function (url, cached) {
+    if (revalidated[url] && Date.now() - revalidated[url] < REVALIDATE_INTERVAL) {
+        return Promise.resolve(true);
+    }
+    return fetch(url, { method: 'HEAD' }).then(function (response) {
+        if (response.status == 404) {
+            return false;
+        }
+        if (!response.ok) {
+            return true;
+        }
+        var current = getValidator(response) == getValidator(cached) &&
+            response.headers.get('Content-Length') == cached.headers.get('Content-Length');
+        if (current) {
+            revalidated[url] = Date.now();
+        }
+        return current;
+    }).catch(function () {
+        // offline, the cached copy is all there is
+        return true;
+    });
+};
+
+
+var cachedRecording = function (request) {
+    return caches.open(RECORDING_CACHE).then(function (cache) {
+        return cache.match(request.url);
+    }).then(function (cached) {
+        if (!cached) {
+            return fetch(request);
+        }
+        return isCurrent(request.url, cached).then(function (current) {
+            if (current) {
+                return rangeResponse(request, cached);
+            }
+            return discardRecording(request.url).then(function () {
+                return fetch(request);
+            });
+        });
+    });
+};
+
+
+self.addEventListener('fetch', function (event) {
+    var request = event.request;
+    if (request.method != 'GET') {
+        return;
+    }
+    var url = new URL(request.url);
+    if (url.origin == self.location.origin && url.pathname.startsWith('/recordings/')) {
+        event.respondWith(cachedRecording(request));
+    } else if (request.mode == 'navigate') {
+        event.respondWith(networkFirst(request, '/'));
+    } else if (url.origin == self.location.origin && url.pathname == '/video') {
+        // remember the last announcement so a cached recording plays offline
+        event.respondWith(networkFirst(request));
+    } else if (isShellAsset(url)) {
+        event.respondWith(staleWhileRevalidate(request));
+    }
+});
+
+
+var chunkKey = function (url, start) {
+    return url + '?chunk=' + start;
+};
+
+
+var evictRecordings = function (keepUrl) {
+    return Promise.all([RECORDING_CACHE, CHUNK_CACHE].map(function (name) {
+        return caches.open(name).then(function (cache) {
+            return cache.keys().then(function (requests) {
+                return Promise.all(requests.filter(function (req) {
+                    return !req.url.startsWith(keepUrl);
+                }).map(function (req) {
+                    console.log('evicting cached recording ' + req.url);
+                    return cache.delete(req);
+                }));
+            });
+        });
+    }));
+};
+
+
+var hasRoomFor = function (bytes, keepUrl) {
+    if (!(self.navigator.storage && self.navigator.storage.estimate)) {
+        return Promise.resolve(true);
+    }
+    var fits = function (estimate) {
+        return estimate.usage + bytes <= estimate.quota * QUOTA_USAGE_LIMIT;
+    };
+    return self.navigator.storage.estimate().then(function (estimate) {
+        if (fits(estimate)) {
+            return true;
+        }
+        return evictRecordings(keepUrl).then(function () {
+            return self.navigator.storage.estimate();
+        }).then(fits);
+    });
+};
+
+
+var deleteChunks = function (url) {
+    return caches.open(CHUNK_CACHE).then(function (chunks) {
+        return chunks.keys().then(function (requests) {
+            return Promise.all(requests.filter(function (req) {
+                return req.url.startsWith(url);
+            }).map(function (req) {
+                return chunks.delete(req);
+            }));
+        });
+    });
+};
+
+
+// Join the chunks of url into one cached response. Resolves to false when
+// a chunk has gone missing; the metadata is then rewound to that chunk so
+// the next prefetch fetches it again.
+var assembleRecording = function (url, info) {
+    return caches.open(CHUNK_CACHE).then(function (chunks) {
+        var starts = [];
+        for (var start = 0; start < info.size; start += CHUNK_SIZE) {
+            starts.push(start);
+        }
+        return Promise.all(starts.map(function (start) {
+            return chunks.match(chunkKey(url, start));
+        })).then(function (parts) {
+            var missing = parts.indexOf(undefined);
+            if (missing >= 0) {
+                console.log('chunk ' + starts[missing] + ' of ' + url + ' is missing.. refetching');
+                info.next = starts[missing];
+                return chunks.put(url, new Response(JSON.stringify(info))).then(function () {
+                    return false;
+                });
+            }
+            return Promise.all(parts.map(function (part) {
+                return part.blob();
+            })).then(function (blobs) {
+                var blob = new Blob(blobs, { type: info.contentType });
+                var headers = {
+                    'Content-Type': info.contentType,
+                    'Content-Length': String(blob.size)
+                };
+                headers[info.validatorHeader] = info.validator;
+                return caches.open(RECORDING_CACHE).then(function (cache) {
+                    return cache.put(url, new Response(blob, { headers: headers }));
+                });
+            }).then(function () {
+                return deleteChunks(url);
+            }).then(function () {
+                console.log('recording ' + url + ' cached for offline replay');
+                return evictRecordings(url);
+            }).then(function () {
+                return true;
+            }, function (err) {
+                // do not leave a copy behind that can never be assembled
+                console.log('could not assemble ' + url + ': ' + err);
+                return deleteChunks(url).then(function () {
+                    return true;
+                });
+            });
+        });
+    });
+};
+
+
+var storeChunk = function (url, chunks, response, start, end, total, info) {
+    info.next = Math.min(end + 1, total);
+    // the Cache API refuses to store partial (206) responses
+    return response.blob().then(function (blob) {
+        return chunks.put(chunkKey(url, start), new Response(blob));
+    }).then(function () {
+        return chunks.put(url, new Response(JSON.stringify(info)));
+    }).then(function () {
+        if (info.next < total) {
+            return false;
+        }
+        return assembleRecording(url, info);
+    });
+};
+
+
+// Fetch the next missing range of url. Resolves to true once the whole
+// recording is in the recording cache, so the page can stop asking.
+// The newest recording may still be written while it is announced, so
+// every range is tied to the first one by If-Range and the file size;
+// if the file changed underneath, the chunks are dropped and it starts over.
+var prefetchChunk = function (url) {
+    return caches.open(RECORDING_CACHE).then(function (recordings) {
+        return recordings.match(url);
+    }).then(function (complete) {
+        if (complete) {
+            return true;
+        }
+        return caches.open(CHUNK_CACHE).then(function (chunks) {
+            return chunks.match(url).then(function (meta) {
+                return meta ? meta.json() : null;
+            }).then(function (info) {
+                if (info && info.next >= info.size) {
+                    return assembleRecording(url, info);
+                }
+                var start = info ? info.next : 0;
+                var end = start + CHUNK_SIZE - 1;
+                return hasRoomFor(CHUNK_SIZE, url).then(function (room) {
+                    if (!room) {
+                        console.log('not enough storage quota to prefetch ' + url);
+                        return true;
+                    }
+                    var headers = { 'Range': 'bytes=' + start + '-' + end };
+                    if (info && info.validator) {
+                        headers['If-Range'] = info.validator;
+                    }
+                    return fetch(url, { headers: headers }).then(function (response) {
+                        if (response.status == 200 && info) {
+                            // If-Range did not match, the whole new file is on its way
+                            if (response.body) {
+                                response.body.cancel();
+                            }
+                            return discardRecording(url).then(function () {
+                                return false;
+                            });
+                        }
+                        if (response.status != 206) {
+                            throw new Error('server did not honor range request for ' + url);
+                        }
+                        var total = parseInt(response.headers.get('Content-Range').split('/')[1], 10);
+                        var validator = getValidator(response);
+                        if (info && (total != info.size || validator != info.validator)) {
+                            return discardRecording(url).then(function () {
+                                return false;
+                            });
+                        }
+                        if (!info) {
+                            // assembly briefly holds the chunks and the joined copy
+                            return hasRoomFor(total * 2, url).then(function (room) {
+                                if (!room) {
+                                    if (response.body) {
+                                        response.body.cancel();
+                                    }
+                                    console.log('not enough storage quota to cache ' + url);
+                                    return true;
+                                }
+                                return storeChunk(url, chunks, response, start, end, total, {
+                                    size: total,
+                                    contentType: response.headers.get('Content-Type') || 'video/mp4',
+                                    validator: validator,
+                                    validatorHeader: response.headers.get('ETag') ? 'ETag' : 'Last-Modified'
+                                });
+                            });
+                        }
+                        return storeChunk(url, chunks, response, start, end, total, info);
+                    });
+                });
+            });
+        });
+    });
+};
+
+
+self.addEventListener('message', function (event) {
+    var data = event.data || {};
+    var port = event.ports[0];
+    if (data.action == 'prefetch' && data.url) {
+        var url = new URL(data.url, self.location.origin).href;
+        event.waitUntil(prefetchChunk(url).then(function (done) {
+            if (port) {
+                port.postMessage({ done: done });
+            }
+        }).catch(function (err) {
+            console.log('could not prefetch ' + url + ': ' + err);
+            if (port) {
+                port.postMessage({ done: true });
+            }
+        }));
+    }
+});
@@ -6,14 +6,18 @@ import glob
 import json
 import signal
 import logging
-import requests
 import subprocess
 import tempfile
 import threading
 import time
 
+STARTUP_TIME = time.time()
+
+import requests
+
 FFMPEGCMD = '/usr/bin/ffmpeg -y'
 ARGS = '-c copy'
+STARTUP_RETRY_INTERVAL = 1
 
 LOGFORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
@@ -70,6 +74,23 @@ def query_stream():
         LOG.error('error querying video streams: %s' % ex)
         return {}
 
+
+def wait_for_webapp(exit_event):
+    READY_URL = 'http://localhost:%s/ready' % CONFIG['WEB_SERVICE_PORT']
+    deadline = time.time() + CONFIG['POLL_INTERVAL']
+    while not exit_event.is_set() and time.time() < deadline:
+        try:
+            resp = requests.get(READY_URL, timeout=STARTUP_RETRY_INTERVAL)
+            # older webapps have no readiness endpoint, they are ready once they answer
+            if resp.status_code in (200, 404):
+                return True
+        except Exception:
+            pass
+        exit_event.wait(timeout=STARTUP_RETRY_INTERVAL)
+    LOG.error('webapp was not ready after %s seconds' % CONFIG['POLL_INTERVAL'])
+    return False
+
+
 def save_config():
     global CONFIG
     LOG.debug('saving configuration')
@@ -160,6 +181,10 @@ class recorderThread (threading.Thread):
 
     def run(self):
         LOG.debug('HLS recorder thread started')
+        started = time.time()
+        wait_for_webapp(self.recorderExit)
+        LOG.info('HLS recorder ready in %dms (waited %dms for webapp)' % (
+            (time.time() - STARTUP_TIME) * 1000, (time.time() - started) * 1000))
         while not self.recorderExit.is_set():
             try:
                 streams = query_stream()
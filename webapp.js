@@ -6,8 +6,13 @@ var player = null;
 var bindKeyboard = true;
 var watchForLiveStream = null;
 var waitForLiveStreamPlay = null;
+var waitingForLiveAudio = false;
 var currentCount = 1;
+var LIVE_AUDIO_POLL_INTERVAL = 5000;
 var isLive = false;
+var audioOnly = false;
+var liveAudioAvailable = false;
+var prefetchingRecording = null;
 
 var _osd_click_handlers = [];
 var _osd_keydown_handlers = [];
@@ -28,6 +33,32 @@ var showMenu = function () {
 };
 
 
+var setAudioOnly = function (value) {
+    audioOnly = value;
+    try {
+        localStorage.setItem('audioOnly', value);
+    } catch (e) {
+        console.log('can not persist audio only preference');
+    }
+};
+
+
+var getAudioOnly = function () {
+    var match = /[?&]audio=([^&]*)/.exec(window.location.search);
+    if (match) {
+        setAudioOnly(match[1] == '1');
+        return audioOnly;
+    }
+    try {
+        return localStorage.getItem('audioOnly') == 'true';
+    } catch (e) {
+        return false;
+    }
+};
+
+audioOnly = getAudioOnly();
+
+
 var getVideoUrl = function () {
     var videoReq = new XMLHttpRequest();
     videoReq.addEventListener('load', function () {
@@ -38,6 +69,8 @@ var getVideoUrl = function () {
                 if (waitForLiveStreamPlay) {
                     console.log('clearing live stream play poller');
                     clearInterval(waitForLiveStreamPlay);
+                    waitForLiveStreamPlay = null;
+                    waitingForLiveAudio = false;
                     console.log('live stream ended waiting for user to play.. reverting to last meeting recording');
                     watchForLiveStream = null;
                     showVideo(respObj.url, respObj.poster);
@@ -48,6 +81,7 @@ var getVideoUrl = function () {
                     console.log('setting player to latest meeting recording');
                     showVideo(respObj.url, respObj.poster);
                 }
+                prefetchRecording(respObj.url);
             } else {
                 isLive = true;
                 if (watchForLiveStream) {
@@ -55,8 +89,35 @@ var getVideoUrl = function () {
                     clearInterval(watchForLiveStream);
                     watchForLiveStream = null;
                 }
-                console.log('setting player to live video');
-                showVideo(respObj.url, respObj.poster);
+                liveAudioAvailable = respObj.audioAvailable;
+                if (audioOnly && liveAudioAvailable && !respObj.audioUrl) {
+                    // the rendition is starting, wait for it instead of pulling the full video
+                    if (!waitingForLiveAudio) {
+                        console.log('live audio not available yet.. starting live audio poller');
+                        waitingForLiveAudio = true;
+                        showVideo('/processing_en.mp4', respObj.poster);
+                        if (waitForLiveStreamPlay) {
+                            clearInterval(waitForLiveStreamPlay);
+                        }
+                        waitForLiveStreamPlay = setInterval(getVideoUrl, LIVE_AUDIO_POLL_INTERVAL);
+                        if (respObj.countNeeded) {
+                            getCount();
+                        }
+                    }
+                    return;
+                }
+                if (waitingForLiveAudio) {
+                    waitingForLiveAudio = false;
+                    clearInterval(waitForLiveStreamPlay);
+                    waitForLiveStreamPlay = null;
+                }
+                if (audioOnly && respObj.audioUrl) {
+                    console.log('setting player to live audio only');
+                    showVideo(respObj.audioUrl, respObj.poster);
+                } else {
+                    console.log('setting player to live video');
+                    showVideo(respObj.url, respObj.poster);
+                }
                 setTimeout(function () {
                     if (!player.isPlaying()) {
                         console.log('live stream not playing yet.. starting live stream play poller');
@@ -67,6 +128,7 @@ var getVideoUrl = function () {
                         if (waitForLiveStreamPlay) {
                             console.log('clearing live stream play poller');
                             clearInterval(waitForLiveStreamPlay);
+                            waitForLiveStreamPlay = null;
                         }
                     }
                 }, 2000);
@@ -76,6 +138,13 @@ var getVideoUrl = function () {
             }
         }
     });
+    videoReq.addEventListener('error', function () {
+        console.log('could not reach the box');
+        // the pollers already retry, only the first request needs help
+        if (!watchForLiveStream && !waitForLiveStreamPlay) {
+            setTimeout(getVideoUrl, 10000);
+        }
+    });
     videoReq.open('GET', '/video');
     videoReq.send();
 };
@@ -110,6 +179,7 @@ var showVideo = function (url, poster) {
             clearInterval(waitForLiveStreamPlay);
             waitForLiveStreamPlay = null;
         }
+        waitingForLiveAudio = false;
         setTimeout(function () {
             console.log('recovering from playback error... ');
             getVideoUrl();
@@ -117,8 +187,10 @@ var showVideo = function (url, poster) {
     });
     player.on(Clappr.Events.PLAYER_PLAY, function () {
         console.log('playing');
-        if (waitForLiveStreamPlay) {
+        // the stand by clip playing must not stop the wait for live audio
+        if (waitForLiveStreamPlay && !waitingForLiveAudio) {
             clearInterval(waitForLiveStreamPlay);
+            waitForLiveStreamPlay = null;
         }
     });
     player.attachTo(playerElement);
@@ -343,12 +415,27 @@ var getCount = function () {
     formContent += "<input type='button' id='incrementCount' value=' + ' onclick='incrementCount(event, this);'>";
     formContent += "<input type='button' id='decrementCount' value=' - ' onclick='deccrementCount(event, this);'><br />";
     formContent += "<p><input type='button' id='enterCount' value=' Enter ' onclick='setCount()'></p>";
+    if (liveAudioAvailable) {
+        formContent += "<p><input type='button' id='toggleAudioOnly' value=' " +
+            (audioOnly ? "Watch Video" : "Listen Only") + " ' onclick='toggleAudioOnly(event, this);'></p>";
+    }
     osdContent(formContent,setCount,setCount);
     document.getElementById('count').innerHTML = currentCount;
     document.getElementById('enterCount').focus();
 };
 
 
+var toggleAudioOnly = function (event, el) {
+    if (event.stopPropagation) {
+        event.stopPropagation();
+    }
+    setAudioOnly(!audioOnly);
+    console.log('switching live meeting to ' + (audioOnly ? 'audio only' : 'video'));
+    osdContent(null);
+    getVideoUrl();
+};
+
+
 var incrementCount = function (event, el) {
     currentCount++;
     document.getElementById('count').innerHTML = currentCount;
@@ -391,3 +478,68 @@ var getRecordings = function () {
 };
 
 
+// Most browsers do not say what kind of network they are on, so only
+// hold back when the device asks to save data or reports a cellular link.
+var onUnmeteredNetwork = function () {
+    var connection = navigator.connection;
+    if (!connection) {
+        return true;
+    }
+    return !connection.saveData && connection.type != 'cellular';
+};
+
+
+var whenIdle = function (callback) {
+    if (window.requestIdleCallback) {
+        window.requestIdleCallback(callback, { timeout: 60000 });
+    } else {
+        setTimeout(callback, 5000);
+    }
+};
+
+
+var prefetchRecording = function (url) {
+    if (!url || !url.startsWith('/recordings/')) {
+        return;
+    }
+    if (prefetchingRecording == url) {
+        return;
+    }
+    if (!(navigator.serviceWorker && navigator.serviceWorker.controller)) {
+        return;
+    }
+    prefetchingRecording = url;
+    var nextChunk = function () {
+        if (prefetchingRecording != url) {
+            return;
+        }
+        if (isLive || (player && player.isPlaying()) || !onUnmeteredNetwork()) {
+            // check back later instead of competing with playback
+            setTimeout(function () { whenIdle(nextChunk); }, 30000);
+            return;
+        }
+        var channel = new MessageChannel();
+        channel.port1.onmessage = function (event) {
+            if (event.data.done) {
+                console.log('finished prefetching ' + url);
+            } else {
+                whenIdle(nextChunk);
+            }
+        };
+        navigator.serviceWorker.controller.postMessage(
+            { action: 'prefetch', url: url }, [channel.port2]);
+    };
+    console.log('prefetching ' + url + ' while idle');
+    whenIdle(nextChunk);
+};
+
+
+if ('serviceWorker' in navigator) {
+    var swUrl = '/sw.js';
+    if (document.currentScript) {
+        swUrl += '?jsapp=' + encodeURIComponent(new URL(document.currentScript.src).pathname);
+    }
+    navigator.serviceWorker.register(swUrl).catch(function (err) {
+        console.log('could not register service worker: ' + err);
+    });
+}
@@ -5,7 +5,6 @@ import os
 import json
 import glob
 import datetime
-import requests
 import uuid
 import logging
 import signal
@@ -13,11 +12,11 @@ import threading
 import time
 import subprocess
 
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
+STARTUP_TIME = time.time()
+
+import requests
 
-from flask import Flask, request, jsonify, Response, render_template
+from flask import Flask, request, jsonify, Response, render_template, send_from_directory
 
 KHCONF_BASE_URL = 'https://report.khconf.com/video_api.php'
 UA = 'info[ua]=Mozilla/5.0+(X11;+Linux+x86_64)+AppleWebKit/537.36+(KHTML,+like+Gecko)+Chrome/79.0.3945.79+Safari/537.36'
@@ -27,6 +26,12 @@ OS = 'info[os][name]=Linux&info[os][version]=x86_64'
 CPU = 'cpu[architecture]=amd_64'
 BROWSER_INFO = "%s&%s&%s&%s&%s" % (UA, BW, EN, OS, CPU)
 CLIENT_VERSION = '1.1.5'
+UPSTREAM_TIMEOUT = 10
+
+FFMPEGCMD = '/usr/bin/ffmpeg'
+AUDIO_ARGS = '-vn -c:a copy -f hls -hls_time 6 -hls_list_size 10 -hls_flags delete_segments'
+AUDIO_PLAYLIST = 'live.m3u8'
+AUDIO_MAX_RESTARTS = 3
 
 CONFIG = {
     'WEB_SERVICE_PORT': 3100,
@@ -36,21 +41,32 @@ CONFIG = {
     'TOKEN': None,
     'ADMIN_PIN': None,
     'VIEWER_PIN': '000000',
-    'CONGREGATION_NAME': None
+    'CONGREGATION_NAME': None,
+    'AUDIO_RENDITION': True
 }
 
 
 CONFIG_FILE = None
+STATE_FILE = None
 
 LOGFORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 JSAPP = None
 
+STARTUP_PHASES = {}
+READY = threading.Event()
+
 congregationName = None
 liveMeetingVriId = None
 liveMeetingVdrId = None
 liveMeetingStreamUrl = None
 liveMeetingCounts = {}
+liveAudioProcess = None
+liveAudioStreamUrl = None
+liveAudioRestarts = 0
+latestRecording = None
+latestRecordingDirMtime = None
+latestRecordingLock = threading.RLock()
 inMeeting = False
 
 consoleLog = logging.StreamHandler()
@@ -162,7 +178,9 @@ def current_video_service():
             'poster': '/posters/%s' % make_live_poster(CONFIG['CONGREGATION_NAME']),
             'meetingDateString': datestring,
             'countNeeded': True,
-            'pollInterval': (CONFIG['POLL_INTERVAL'] * 2)
+            'pollInterval': (CONFIG['POLL_INTERVAL'] * 2),
+            'audioUrl': get_live_audio_url(),
+            'audioAvailable': get_live_audio_available()
         }
         clientip = request.remote_addr
         if clientip in liveMeetingCounts:
@@ -180,30 +198,35 @@ def current_video_service():
             'countNeeded': False,
             'pollInterval': (CONFIG['POLL_INTERVAL'] * 2)
         }
-        recdir = "%s/static/recordings" % os.path.dirname(
-            os.path.realpath(__file__))
-        if not os.path.exists(recdir):
-            os.makedirs(recdir)
-        list_of_recs = glob.glob("%s/*" % recdir)
-        if list_of_recs:
-            latest_rec = max(list_of_recs, key=os.path.getmtime)
-            recording_file = os.path.basename(latest_rec)
-            datestring = datetime.datetime.fromtimestamp(
-                os.path.getmtime(latest_rec)).strftime('%m-%d-%Y')
+        latest = get_latest_recording()
+        if latest:
             LOG.info('directing cliet to %s meeting recording %s from %s' %
-                     (CONFIG['CONGREGATION_NAME'], recording_file, datestring))    
+                     (CONFIG['CONGREGATION_NAME'], latest['file'], latest['datestring']))
             rec = {
-                'url': "/recordings/%s" % recording_file,
+                'url': "/recordings/%s" % latest['file'],
                 'congregation': CONFIG['CONGREGATION_NAME'],
                 'live': False,
-                'poster': '/posters/%s' % make_recording_poster(recording_file, CONFIG['CONGREGATION_NAME'], datestring),
-                'meetingDateString': datestring,
+                'poster': '/posters/%s' % latest['poster'],
+                'meetingDateString': latest['datestring'],
                 'countNeeded': False,
                 'pollInterval': (CONFIG['POLL_INTERVAL'] * 2)
             }
         return jsonify(rec)
 
 
+@app.route('/ready', methods=['GET'])
+def readiness():
+    status = {
+        'ready': READY.is_set(),
+        'uptime': round(time.time() - STARTUP_TIME, 3),
+        'phases': STARTUP_PHASES
+    }
+    response = jsonify(status)
+    if not READY.is_set():
+        response.status_code = 503
+    return response
+
+
 @app.route('/count', methods=['POST'])
 def submit_count():
     if inMeeting and liveMeetingVriId:
@@ -252,6 +275,18 @@ def index():
         return render_template('getvideo.html', jsapp=JSAPP)
 
 
+@app.route('/audio/<path:path>')
+def live_audio(path):
+    # the playlist is rewritten every segment, so it must never be cached
+    return send_from_directory(get_live_audio_dir(), path, cache_timeout=0)
+
+
+@app.route('/sw.js')
+def service_worker():
+    # browsers only pick up a new service worker if the script is not cached
+    return send_from_directory(app.static_folder, 'sw.js', cache_timeout=0)
+
+
 @app.route('/<path:path>')
 def catch_all(path):
     return app.send_static_file(path)
@@ -278,6 +313,47 @@ def load_config(config_file=None):
             CONFIG = json.load(json_data_file)
 
 
+def record_phase(phase, started):
+    STARTUP_PHASES[phase] = round((time.time() - started) * 1000, 1)
+    LOG.debug('startup phase %s took %sms' % (phase, STARTUP_PHASES[phase]))
+
+
+def save_snapshot():
+    LOG.debug('saving warm cache snapshot to %s' % STATE_FILE)
+    tmp_file = "%s.tmp" % STATE_FILE
+    try:
+        with latestRecordingLock:
+            # replace the snapshot atomically so a power cut can not truncate it
+            with open(tmp_file, 'w+') as json_data_file:
+                json_data_file.write(json.dumps({
+                    'LATEST_RECORDING': latestRecording
+                }))
+                json_data_file.flush()
+                os.fsync(json_data_file.fileno())
+            os.replace(tmp_file, STATE_FILE)
+    except Exception as ex:
+        LOG.error('could not save warm cache snapshot: %s' % ex)
+
+
+def restore_snapshot():
+    global latestRecording
+    if not os.path.exists(STATE_FILE):
+        return
+    LOG.debug('restoring warm cache snapshot from %s' % STATE_FILE)
+    try:
+        with open(STATE_FILE) as json_data_file:
+            snapshot = json.load(json_data_file)
+    except Exception as ex:
+        LOG.error('could not read warm cache snapshot: %s' % ex)
+        return
+    static_dir = "%s/static" % os.path.dirname(os.path.realpath(__file__))
+    latest = snapshot.get('LATEST_RECORDING')
+    if latest and \
+            os.path.exists("%s/recordings/%s" % (static_dir, latest['file'])) and \
+            os.path.exists("%s/posters/%s" % (static_dir, latest['poster'])):
+        latestRecording = latest
+
+
 def get_js_alias(jsfilename):
     scriptdir = os.path.dirname(os.path.realpath(__file__))
     jsfilepath = "%s/%s" % (scriptdir, jsfilename)
@@ -293,6 +369,48 @@ def get_js_alias(jsfilename):
     return aliasfilename
 
 
+def get_recordings_dir():
+    return "%s/static/recordings" % os.path.dirname(os.path.realpath(__file__))
+
+
+def refresh_latest_recording():
+    global latestRecording, latestRecordingDirMtime
+    with latestRecordingLock:
+        recdir = get_recordings_dir()
+        if not os.path.exists(recdir):
+            os.makedirs(recdir)
+        # taken before listing so a recording published meanwhile is seen next time
+        latestRecordingDirMtime = os.stat(recdir).st_mtime
+        list_of_recs = glob.glob("%s/*" % recdir)
+        if not list_of_recs:
+            latestRecording = None
+            return None
+        latest_rec = max(list_of_recs, key=os.path.getmtime)
+        recording_file = os.path.basename(latest_rec)
+        if latestRecording and latestRecording['file'] == recording_file:
+            return latestRecording
+        datestring = datetime.datetime.fromtimestamp(
+            os.path.getmtime(latest_rec)).strftime('%m-%d-%Y')
+        latestRecording = {
+            'file': recording_file,
+            'datestring': datestring,
+            'poster': make_recording_poster(recording_file, CONFIG['CONGREGATION_NAME'], datestring)
+        }
+        save_snapshot()
+        return latestRecording
+
+
+def get_latest_recording():
+    # publishing or removing a recording changes the directory mtime
+    latest = latestRecording
+    try:
+        if latest and os.stat(get_recordings_dir()).st_mtime == latestRecordingDirMtime:
+            return latest
+    except OSError:
+        pass
+    return refresh_latest_recording()
+
+
 def get_live_meeting_count():
     meetingCount = 0
     if inMeeting:
@@ -331,6 +449,7 @@ def update_meeting_status():
                 if not oldStreamId == liveMeetingStreamUrl:
                     LOG.error(
                         'meeting id changed within poll cycle..')
+            start_live_audio(liveMeetingStreamUrl)
         else:
             LOG.debug('there is no current live video stream')
             inMeeting = False
@@ -338,6 +457,7 @@ def update_meeting_status():
             liveMeetingVdrId = None
             liveMeetingStreamUrl = None
             liveMeetingCounts = {}
+            stop_live_audio()
             try:
                 if liveMeetingVdrId:
                     unregister_device(CONFIG['DEVICE_ID'], liveMeetingVdrId)
@@ -346,6 +466,80 @@ def update_meeting_status():
             
 
 
+def get_live_audio_dir():
+    return "%s/static/audio" % os.path.dirname(os.path.realpath(__file__))
+
+
+def get_live_audio_available():
+    return bool(CONFIG.get('AUDIO_RENDITION', True)) and \
+        liveAudioRestarts <= AUDIO_MAX_RESTARTS
+
+
+def get_live_audio_url():
+    # the polling thread may stop the rendition while a request reads it
+    process = liveAudioProcess
+    if process and process.poll() is None:
+        if os.path.exists("%s/%s" % (get_live_audio_dir(), AUDIO_PLAYLIST)):
+            return "/audio/%s" % AUDIO_PLAYLIST
+    return None
+
+
+def clear_live_audio_dir():
+    audio_dir = get_live_audio_dir()
+    if not os.path.exists(audio_dir):
+        os.makedirs(audio_dir)
+    for filePath in glob.glob("%s/*" % audio_dir):
+        try:
+            os.remove(filePath)
+        except:
+            LOG.error('can not remove old live audio file %s' % filePath)
+    return audio_dir
+
+
+def start_live_audio(url):
+    global liveAudioProcess, liveAudioStreamUrl, liveAudioRestarts
+    if not CONFIG.get('AUDIO_RENDITION', True):
+        return
+    if liveAudioProcess and liveAudioProcess.poll() is None:
+        if liveAudioStreamUrl == url:
+            return
+        stop_live_audio()
+    elif liveAudioProcess:
+        liveAudioRestarts += 1
+        if liveAudioRestarts > AUDIO_MAX_RESTARTS:
+            if liveAudioRestarts == AUDIO_MAX_RESTARTS + 1:
+                LOG.error('live audio rendition exited with status %s.. giving up for this meeting' %
+                          liveAudioProcess.returncode)
+            return
+        LOG.error('live audio rendition exited with status %s.. restarting' %
+                  liveAudioProcess.returncode)
+    audio_dir = clear_live_audio_dir()
+    cmd = FFMPEGCMD.split() + ['-y', '-nostats', '-loglevel', 'warning', '-i', url] + AUDIO_ARGS.split() + \
+        ["%s/%s" % (audio_dir, AUDIO_PLAYLIST)]
+    LOG.info('starting live audio rendition of %s' % url)
+    LOG.debug('running command: %s' % ' '.join(cmd))
+    # like the recorder, let ffmpeg report its errors to the service journal
+    liveAudioProcess = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+    liveAudioStreamUrl = url
+
+
+def stop_live_audio():
+    global liveAudioProcess, liveAudioStreamUrl, liveAudioRestarts
+    if liveAudioProcess:
+        LOG.info('stopping live audio rendition of %s' % liveAudioStreamUrl)
+        if liveAudioProcess.poll() is None:
+            liveAudioProcess.terminate()
+            try:
+                liveAudioProcess.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                liveAudioProcess.kill()
+                liveAudioProcess.wait()
+        clear_live_audio_dir()
+        liveAudioProcess = None
+        liveAudioStreamUrl = None
+        liveAudioRestarts = 0
+
+
 def submitting_count():
     global liveMeetingVdrId
     if liveMeetingVriId:
@@ -364,6 +558,8 @@ def make_recording_poster(recording_file, congregation, datestring):
     file_name = "%s.jpg" % str(recording_file).replace('.', '_')
     if not os.path.exists("%s/%s" % (posters_dir, file_name)):
         LOG.debug('recording found without poster.. creating')
+        # Pillow is slow to import, only pay for it when a poster is drawn
+        from PIL import Image, ImageFont, ImageDraw
         poster_backgroud = "%s/resources/poster_background.jpg" % os.path.dirname(
             os.path.realpath(__file__))
         img = Image.open(poster_backgroud)
@@ -388,6 +584,7 @@ def make_live_poster(congregation):
     file_name = "%s_live.jpg" % str(congregation).replace(' ', '_')
     if not os.path.exists("%s/%s" % (posters_dir, file_name)):
         LOG.debug('creating %s live meeting poster' % congregation)
+        from PIL import Image, ImageFont, ImageDraw
         poster_backgroud = "%s/resources/poster_background.jpg" % os.path.dirname(
             os.path.realpath(__file__))
         img = Image.open(poster_backgroud)
@@ -414,7 +611,7 @@ def register_device(token, device_id):
     REGISTER_URL = "%s/register/%s/%s" % (KHCONF_BASE_URL, token, device_id)
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data = 'info=%s&fingerprint=%s' % (BROWSER_INFO, generate_fingerprint())
-    resp = requests.post(url=REGISTER_URL, data=data, headers=headers)
+    resp = requests.post(url=REGISTER_URL, data=data, headers=headers, timeout=UPSTREAM_TIMEOUT)
     resp.raise_for_status()
     # Yep.. they are that messed up.. they can't do JSON
     # This is what the output looks like.. nested JSON in JSON.. nice log capture
@@ -426,7 +623,7 @@ def register_device(token, device_id):
 
 def get_streams(device_id):
     PLAYLIST_URL = "%s/video/%s" % (KHCONF_BASE_URL, device_id)
-    resp = requests.get(url=PLAYLIST_URL)
+    resp = requests.get(url=PLAYLIST_URL, timeout=UPSTREAM_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
@@ -435,7 +632,7 @@ def get_vdr_id(device_id, vri, count=0):
     CONF_ID_URL = "%s/vdr" % (KHCONF_BASE_URL)
     data = {'device_id': device_id, 'vri': vri, 'count': count,
             'duration': CONFIG['POLL_INTERVAL'], 'client_version': CLIENT_VERSION}
-    resp = requests.post(url=CONF_ID_URL, data=data)
+    resp = requests.post(url=CONF_ID_URL, data=data, timeout=UPSTREAM_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
@@ -443,7 +640,7 @@ def get_vdr_id(device_id, vri, count=0):
 def unregister_device(device_id, vdr_id):
     UNREGISTER_URL = "%s/vdr/%s/delete" % (KHCONF_BASE_URL, vdr_id)
     data = {'device_id': device_id}
-    resp = requests.post(url=UNREGISTER_URL, data=data)
+    resp = requests.post(url=UNREGISTER_URL, data=data, timeout=UPSTREAM_TIMEOUT)
     resp.raise_for_status()
     return resp.json()
 
@@ -456,26 +653,56 @@ class pollingThread (threading.Thread):
 
     def run(self):
         LOG.debug('KHConf video services polling thread started')
+        first_poll = True
         while not self.pollExit.is_set():
+            started = time.time()
             try:
                 update_meeting_status()
             except Exception as ex:
                 LOG.error('could not update meeting status: %s' % ex)
+            if first_poll:
+                record_phase('first_poll', started)
+                first_poll = False
+            if not inMeeting:
+                try:
+                    refresh_latest_recording()
+                except Exception as ex:
+                    LOG.error('could not refresh latest recording: %s' % ex)
             self.pollExit.wait(timeout=CONFIG['POLL_INTERVAL'])
+        stop_live_audio()
 
     def join(self):
         self.pollExit.set()
         super().join()
 
 
+class warmupThread (threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+
+    def run(self):
+        started = time.time()
+        try:
+            if CONFIG['CONGREGATION_NAME']:
+                make_live_poster(CONFIG['CONGREGATION_NAME'])
+            if not refresh_latest_recording():
+                save_snapshot()
+        except Exception as ex:
+            LOG.error('could not warm caches: %s' % ex)
+        record_phase('warm_caches', started)
+
+
 def initialize():
-    global JSAPP
+    global JSAPP, STATE_FILE
     LOG.setLevel(logging.DEBUG)
+    started = time.time()
     config_file = os.getenv('CONFIG_FILE', None)
     load_config(config_file)
     if not CONFIG['DEVICE_ID']:
         CONFIG['DEVICE_ID'] = str(uuid.uuid4())
         save_config()  
+    record_phase('load_config', started)
     log_file = os.getenv('LOGFILE', CONFIG['LOGFILE'])
     if log_file:
         LOG.info('switching to file logging: %s' % log_file)
@@ -490,12 +717,29 @@ def initialize():
     requests_log.setLevel(CONFIG['LOGLEVEL'])
     app.logger.setLevel(CONFIG['LOGLEVEL'])
 
+    started = time.time()
+    STATE_FILE = os.getenv('STATE_FILE', "%s/webapp_state.json" % os.path.dirname(
+        os.path.realpath(__file__)))
+    restore_snapshot()
+    record_phase('restore_snapshot', started)
+
+    started = time.time()
     LOG.info('creating symlink to versioned webapp.js')
     JSAPP = get_js_alias('webapp.js')
+    record_phase('js_alias', started)
+
+    # upstream may be unreachable for minutes after a power cut, so
+    # readiness only covers local startup; the first poll is its own phase
+    record_phase('ready', STARTUP_TIME)
+    READY.set()
+    LOG.info('KHConf video services ready in %sms' % STARTUP_PHASES['ready'])
 
     polling_thread = pollingThread()
     polling_thread.start()
 
+    warmup_thread = warmupThread()
+    warmup_thread.start()
+
 
 def main():
     app.run(host='0.0.0.0',